@@ -1,10 +1,27 @@
 from flask import Flask, render_template, request, jsonify, send_file
+from werkzeug.exceptions import RequestEntityTooLarge
 import encryption
-import decryption
-from decryption import parseKey
+from decryption import parseKey, checkImageSize
+from governor import BudgetExceeded, Deadline
+from PIL import Image
+import governor
+import sharded
+import io
 import os
 
 app = Flask(__name__, template_folder='.')
+# Pick the engine once at startup, an unknown IMAGECRYPTO_ENGINE fails here
+encrypt_text, decrypt_image = sharded.engineFunctions(governor.ENGINE)
+# Reject oversized uploads before Flask buffers them (room for an uncompressed PNG)
+app.config['MAX_CONTENT_LENGTH'] = max(governor.MAX_TEXT_BYTES, governor.MAX_IMAGE_PIXELS * 3) + 64 * 1024
+
+def budget_error(e):
+    return jsonify({'success': False, 'error': str(e), 'budget': e.budget})
+
+@app.errorhandler(413)
+def request_too_large(e):
+    governor.recordViolation('request_bytes')
+    return jsonify({'success': False, 'error': 'Upload is too large.', 'budget': 'request_bytes'}), 413
 
 @app.route('/')
 def index():
@@ -15,8 +32,10 @@ def encrypt():
     # Handle CORS/preflight or stray OPTIONS gracefully
     if request.method == 'OPTIONS':
         return ('', 204)
+    deadline = Deadline()
     try:
         use_file = request.form.get('use_file', 'false') == 'true'
+        packed = request.form.get('packed', 'false') == 'true'
         text = ''
 
         if use_file:
@@ -29,25 +48,36 @@ def encrypt():
             if not upload.filename.lower().endswith('.txt'):
                 return jsonify({'success': False, 'error': 'Only .txt files are allowed'})
             try:
-                raw = upload.read()
+                raw = upload.read(governor.MAX_TEXT_BYTES + 1)
+                governor.checkTextBytes(len(raw))
                 text = raw.decode('utf-8', errors='replace')
+            except BudgetExceeded:
+                raise
             except Exception as fe:
                 return jsonify({'success': False, 'error': f'Failed to read file: {fe}'})
         else:
             # Get text from form
             text = request.form.get('text', '')
+            governor.checkTextBytes(len(text.encode('utf-8')))
             
         if not text:
             return jsonify({'success': False, 'error': 'No text provided'})
 
+        # The resulting image must stay decryptable under the pixel budget
+        governor.checkProjectedPixels(len(text), packed)
+
         # Encrypt the text
-        key = encryption.encryption(text)
+        key = encrypt_text(text, deadline=deadline, packed=packed)
         
         return jsonify({
             'success': True,
             'key': key
         })
     
+    except BudgetExceeded as e:
+        return budget_error(e)
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -55,6 +85,7 @@ def encrypt():
 def decrypt():
     if request.method == 'OPTIONS':
         return ('', 204)
+    deadline = Deadline()
     key = request.form.get('key', '')
     if not key:
         return jsonify({'success': False, 'error': 'No key provided'})
@@ -87,9 +118,35 @@ def decrypt():
     if not any(cmd.get('type') == 's' for cmd in cmds):
         os.unlink(temp_image_path)
         return jsonify({'success': False, 'error': "Invalid key: missing 's' (channel shuffle) command."})
+    try:
+        governor.checkKeyCommands(cmds)
+    except BudgetExceeded as e:
+        os.unlink(temp_image_path)
+        return budget_error(e)
+
+    # Check the PNG header only (size budget, key's image info) before decoding any pixels
+    try:
+        with Image.open(temp_image_path) as header:
+            governor.checkImagePixels(header.size)
+            size_error = checkImageSize(cmds, header.size)
+    except BudgetExceeded as e:
+        os.unlink(temp_image_path)
+        return budget_error(e)
+    except ValueError:
+        os.unlink(temp_image_path)
+        return jsonify({'success': False, 'error': 'Invalid key format.'})
+    except Exception:
+        os.unlink(temp_image_path)
+        return jsonify({'success': False, 'error': 'Uploaded file is not a valid image.'})
+    if size_error:
+        os.unlink(temp_image_path)
+        return jsonify({'success': False, 'error': size_error})
 
     try:
-        decrypted_text = decryption.decryption(key, temp_image_path)
+        decrypted_text = decrypt_image(key, temp_image_path, deadline=deadline)
+    except BudgetExceeded as e:
+        os.unlink(temp_image_path)
+        return budget_error(e)
     except IndexError:
         os.unlink(temp_image_path)
         return jsonify({'success': False, 'error': 'Decryption failed: the key does not match the uploaded image (missing expected commands). Please ensure you use the exact key produced during encryption for this image.'})
@@ -106,6 +163,44 @@ def decrypt():
 
     return jsonify({'success': True, 'text': decrypted_text})
 
+@app.route('/reencrypt', methods=['POST', 'OPTIONS'])
+def reencrypt():
+    # Add rounds on top of an uploaded encrypted image without decrypting it
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    deadline = Deadline()
+    key = request.form.get('key', '')
+    if not key:
+        return jsonify({'success': False, 'error': 'No key provided'})
+    image_file = request.files.get('image') or request.files.get('uploaded_image')
+    if image_file is None or image_file.filename == '':
+        return jsonify({'success': False, 'error': 'No encrypted image uploaded. Please upload an image.'})
+    rounds = request.form.get('rounds', '')
+    if rounds and not rounds.isdigit():
+        return jsonify({'success': False, 'error': 'Rounds must be a positive number.'})
+    rounds = int(rounds) if rounds else None
+
+    try:
+        cmds = parseKey(key)
+        # Budget for the key after re-encryption, assume the largest random round count
+        governor.checkKeyCommands(cmds, extra=rounds if rounds else 6)
+        image = io.BytesIO(image_file.read())
+        with Image.open(image) as header:
+            governor.checkImagePixels(header.size)
+        image.seek(0)
+        new_key = encryption.reencryption(image, key, rounds, deadline)
+    except BudgetExceeded as e:
+        return budget_error(e)
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Re-encryption failed: {str(e)}'})
+
+    return jsonify({'success': True, 'key': new_key})
+
+@app.route('/metrics')
+def metrics():
+    # Engine in use and rejected requests per budget since the server started
+    return jsonify({'engine': governor.ENGINE, 'budget_violations': governor.violationCounts()})
+
 @app.route('/get-image')
 def get_image():
     try:
@@ -1,7 +1,10 @@
 from PIL import Image
 import numpy as np
+import zlib
 import os
 
+from governor import BAND_PIXELS
+
 numToLetter = [
     'a','b','c','d','e','f','g','h','i','j','k','l','m','n','o','p','q','r','s','t','u','v','w','x','y','z',
     '0','1','2','3','4','5','6','7','8','9',
@@ -55,12 +58,14 @@ def matrix_inverse_mod(matrix, modulus):
     inverse = (det_inv * adjugate) % modulus
     return inverse.astype(int)
 
-def imgToGrid(img):
+def imgToGrid(img, deadline=None):
     """Convert image to 2D grid of pixels"""
     width, height = img.size
     grid = []
     
     for y in range(height):
+        if deadline is not None:
+            deadline.check("image decoding")
         row = []
         for x in range(width):
             r, g, b = img.getpixel((x, y))
@@ -102,8 +107,19 @@ def reverseDummyPixels(pixelArray, dummyMultiplier):
     return realPixels
 
 
-def reverseColorShuffle(pixelArray, usedChannels):
-    """Extract character data from used channels only"""
+def unpackSymbols(data):
+    """Unpack bytes written by encryption.packSymbols, three bytes into four symbols
+    A trailing incomplete group can only be padding and is dropped"""
+    whole = len(data) - len(data) % 3
+    groups = np.array(data[:whole], dtype=np.uint32).reshape(-1, 3)
+    word = (groups[:, 0] << 16) | (groups[:, 1] << 8) | groups[:, 2]
+    symbols = np.stack([word >> 18, (word >> 12) & 63, (word >> 6) & 63, word & 63], axis=1)
+    return symbols.reshape(-1).tolist()
+
+
+def reverseColorShuffle(pixelArray, usedChannels, packed=False):
+    """Extract character data from used channels only
+    With packed=True the channel bytes are unpacked back into 6-bit symbols"""
     charData = []
     
     for pixel in pixelArray:
@@ -111,10 +127,12 @@ def reverseColorShuffle(pixelArray, usedChannels):
             value = pixel[channelPos]
             charData.append(value)
     
+    if packed:
+        charData = unpackSymbols(charData)
     return charData
 
 
-def reverseMatrixObfuscation(pixelArray, matrixData):
+def reverseMatrixObfuscation(pixelArray, matrixData, deadline=None):
     """Reverse the matrix transformation using modular inverse"""
     # Parse matrix from data string
     matrix_values = list(map(int, matrixData.split(',')))
@@ -129,7 +147,9 @@ def reverseMatrixObfuscation(pixelArray, matrixData):
     
     # Apply inverse transformation: P = (M^-1 × P') mod 256
     originalPixels = []
-    for pixel in pixelArray:
+    for i, pixel in enumerate(pixelArray):
+        if deadline is not None and i % BAND_PIXELS == 0:
+            deadline.check("matrix reversal")
         pixel_vec = np.array(pixel, dtype=int)
         original = np.dot(M_inv, pixel_vec) % 256
         originalPixels.append(original.tolist())
@@ -137,7 +157,7 @@ def reverseMatrixObfuscation(pixelArray, matrixData):
     return originalPixels
 
 
-def reverseDetMultiplier(grid, pickedIndex):
+def reverseDetMultiplier(grid, pickedIndex, deadline=None):
     """Reverse the determinant-based cascading transformation
     Must decrypt in FORWARD order since each decrypted pixel is needed for the next"""
     
@@ -164,6 +184,9 @@ def reverseDetMultiplier(grid, pickedIndex):
     # Decrypt in FORWARD order (same direction as encryption)
     # Start from the second row (index = width)
     for i in range(width, len(flatPixels)):
+        if deadline is not None and i % BAND_PIXELS == 0:
+            deadline.check("determinant reversal")
+        
         # Calculate determinant using the SAME reference pixels as during encryption
         matrix = np.array([pixelLeft, pickedPixel, pixelRight], dtype=int)
         det = int(np.round(np.linalg.det(matrix)))
@@ -240,26 +263,82 @@ def parseKey(key):
     return commands
 
 
-def decryption(encryptionKey, image_path):
-    """Main decryption function - requires the key and image path as input"""
+def isPacked(commands):
+    """True if the key has the 'p' command (4 symbols packed into 3 bytes)"""
+    packCommands = [cmd for cmd in commands if cmd['type'] == 'p']
+    if not packCommands:
+        return False
+    if packCommands[0]['data'] != '6':
+        raise ValueError("Invalid key: unsupported 'p' (symbol packing) command.")
+    return True
+
+
+def parseImageInfo(commands):
+    """Read (width, height, pixelCount, checksum) from the optional 'i' command
+    Returns None for keys created before the command existed"""
+    infoCommands = [cmd for cmd in commands if cmd['type'] == 'i']
+    if not infoCommands:
+        return None
+    parts = infoCommands[0]['data'].split(',')
+    if len(parts) != 4:
+        raise ValueError("Invalid key: malformed 'i' (image info) command.")
+    return int(parts[0]), int(parts[1]), int(parts[2]), parts[3]
+
+
+def checkImageSize(commands, size):
+    """Compare an image size (from the PNG header) with the key
+    Returns an error message, or None if the key may belong to the image"""
+    info = parseImageInfo(commands)
+    if info is None:
+        return None
+    width, height, pixelCount, _ = info
+    if (width, height) != tuple(size):
+        return f"Key does not match the uploaded image: the key is for a {width}x{height} image, got {size[0]}x{size[1]}."
+    if pixelCount > width * (height - 1):
+        return "Invalid key: dummy pixel count does not fit the image."
+    return None
+
+
+def checkImageChecksum(commands, pixelBytes):
+    """Compare the raw RGB bytes of the image with the key's checksum
+    Returns an error message, or None if they match"""
+    info = parseImageInfo(commands)
+    if info is None:
+        return None
+    if format(zlib.crc32(pixelBytes), '08x') != info[3]:
+        return "Key does not match the uploaded image: checksum mismatch."
+    return None
+
+
+def decryption(encryptionKey, image_path, deadline=None):
+    """Main decryption function - requires the key and image path as input
+    An optional governor.Deadline is checked between stages and pixel bands"""
     img = Image.open(image_path)
     
-    # Convert image to grid
-    grid = imgToGrid(img)
-    
     # Parse the key
     commands = parseKey(encryptionKey)
     
+    # Reject a mismatched key before touching the pixels
+    error = checkImageSize(commands, img.size) or checkImageChecksum(commands, img.tobytes())
+    if error:
+        raise ValueError(error)
+    
+    # Convert image to grid
+    grid = imgToGrid(img, deadline)
+    
     # Process commands in the order they appear (already in reverse order from encryption)
     # Filter only the manipulation commands (M and m)
     manipulationCommands = [cmd for cmd in commands if cmd['type'] in ['M', 'm']]
     
     # Apply them in the order they appear in the key
     for command in manipulationCommands:
+        if deadline is not None:
+            deadline.check(f"'{command['type']}' command")
+        
         if command['type'] == 'm':
             # Reverse detMultiplier
             randomPos = int(command['data'])
-            grid = reverseDetMultiplier(grid, randomPos)
+            grid = reverseDetMultiplier(grid, randomPos, deadline)
         
         elif command['type'] == 'M':
             # Reverse matrixObfuscation
@@ -270,7 +349,7 @@ def decryption(encryptionKey, image_path):
                     flatPixels.append(pixel)
             
             # Apply reverse matrix transformation
-            flatPixels = reverseMatrixObfuscation(flatPixels, command['data'])
+            flatPixels = reverseMatrixObfuscation(flatPixels, command['data'], deadline)
             
             # Convert back to grid
             height = len(grid)
@@ -285,6 +364,9 @@ def decryption(encryptionKey, image_path):
                         pixelIndex += 1
                 grid.append(row)
     
+    if deadline is not None:
+        deadline.check("dummy pixel removal")
+    
     # Now convert grid back to flat pixel array after all matrix reversals
     pixelArray = reverseGrid(grid)
     
@@ -296,7 +378,8 @@ def decryption(encryptionKey, image_path):
     # 5. Reverse colorShuffle
     shuffleCommand = [cmd for cmd in commands if cmd['type'] == 's'][0]
     usedChannels = [int(ch) for ch in shuffleCommand['data']]
-    charData = reverseColorShuffle(pixelArray, usedChannels)
+    packed = isPacked(commands)
+    charData = reverseColorShuffle(pixelArray, usedChannels, packed)
     
     # Convert character indices back to text
     finalText = ""
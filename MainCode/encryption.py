@@ -1,10 +1,12 @@
 from PIL import Image
 import numpy as np
 import random
+import zlib
 import os
 
-key = ""
-manipulationCommands = []  # Store manipulation commands in order
+from decryption import parseKey, parseImageInfo, checkImageSize, checkImageChecksum, imgToGrid
+from governor import BAND_PIXELS
+
 numToLetter = [
     'a','b','c','d','e','f','g','h','i','j','k','l','m','n','o','p','q','r','s','t','u','v','w','x','y','z',
     '0','1','2','3','4','5','6','7','8','9',
@@ -12,6 +14,9 @@ numToLetter = [
     '@','#','$','&','*','+','=','_','%','\n','þ'
 ]
 NULL_CHAR_INDEX = len(numToLetter) - 1  # Index 63: 'þ'  
+# Largest channel value before the manipulation rounds in packed mode, also used
+# for padding there (255 unpacks to null symbols); plain symbols use NULL_CHAR_INDEX
+PACKED_CHANNEL_MAX = 255
 
 
 def modular_inverse(a, m):
@@ -59,23 +64,71 @@ def matrix_inverse_mod(matrix, modulus):
     return inverse.astype(int)
 
 
-def textToArray(textSize, userText):
+def buildCommand(cmdType, data):
+    """Build a length-prefixed key command: <total_length><type><data>"""
+    data_plus_type = 1 + len(data)
+    length_digits = len(str(data_plus_type))
+    total_length = length_digits + data_plus_type
+    return f"{total_length}{cmdType}{data}"
+
+
+def imageInfoCommand(width, height, pixelCount, pixelBytes):
+    """Build the 'i' command: image size, dummy-expanded pixel count and a
+    CRC-32 of the final pixel bytes, so a wrong key can be rejected early"""
+    checksum = format(zlib.crc32(pixelBytes), '08x')
+    return buildCommand('i', f"{width},{height},{pixelCount},{checksum}")
+
+
+def randomInvertibleMatrix():
+    """Generate a random 3x3 matrix with odd determinant (coprime with 256)"""
+    max_attempts = 100
+    for attempt in range(max_attempts):
+        # Use small random integers to avoid overflow
+        M = np.random.randint(-5, 6, (3, 3))
+        det = int(np.round(np.linalg.det(M)))
+        
+        # Check if determinant is odd (coprime with 256)
+        if det % 2 != 0:
+            # Verify the inverse exists
+            M_inv = matrix_inverse_mod(M, 256)
+            if M_inv is not None:
+                return M
+    # Fallback to identity matrix if no valid matrix found
+    return np.eye(3, dtype=int)
+
+
+def textToArray(textSize, userText, deadline=None, packed=False):
 
     pixelArray = []
     for i in range(textSize):
+                if deadline is not None and i % BAND_PIXELS == 0:
+                    deadline.check("text conversion")
                 char = userText[i].lower()  # Convert to lowercase
                 char_num = numToLetter.index(char) if char in numToLetter else NULL_CHAR_INDEX
                 pixelArray.append(char_num)
 
-    grid = randomizedEncryption(pixelArray)
-    
-    # Create image from the grid
+    grid, key, manipulationCommands, dummyPixelCount = randomizedEncryption(pixelArray, deadline, packed)
+    return gridToImage(grid, deadline), key, manipulationCommands, dummyPixelCount
+
+def packSymbols(symbols):
+    """Bit-pack 6-bit symbols, four symbols into three bytes
+    The last group is padded with null symbols"""
+    padded = list(symbols) + [NULL_CHAR_INDEX] * (-len(symbols) % 4)
+    groups = np.array(padded, dtype=np.uint32).reshape(-1, 4)
+    word = (groups[:, 0] << 18) | (groups[:, 1] << 12) | (groups[:, 2] << 6) | groups[:, 3]
+    packed = np.stack([word >> 16, (word >> 8) & 255, word & 255], axis=1)
+    return packed.reshape(-1).tolist()
+
+def gridToImage(grid, deadline=None):
+    """Create an RGB image from a grid (list of rows of [R, G, B] pixels)"""
     height = len(grid)
     width = len(grid[0]) if height > 0 else 0
     
     img = Image.new('RGB', (width, height))
     
     for y in range(height):
+        if deadline is not None:
+            deadline.check("image building")
         for x in range(width):
             pixel = grid[y][x]
             r = int(pixel[0])
@@ -85,48 +138,54 @@ def textToArray(textSize, userText):
     
     return img
 
-def randomizedEncryption(inputArray):
-    global manipulationCommands
-    manipulationCommands = []  # Reset for new encryption
-    
-    inputArray= colorShuffle(inputArray)
-    inputArray= dummyPixelGenerator(inputArray)
-    inputArray= arrayToGrid(inputArray)
+def randomizedEncryption(inputArray, deadline=None, packed=False):
+    """Returns the grid, the key commands so far, the manipulation commands
+    in the order applied and the pixel count after dummy insertion"""
+    key = ""
+    channelMax = NULL_CHAR_INDEX
+    if packed:
+        # Dense mode: 4 symbols per 3 bytes, recorded as 'p' with the bits per symbol
+        inputArray = packSymbols(inputArray)
+        channelMax = PACKED_CHANNEL_MAX
+        key += buildCommand('p', '6')
+    
+    inputArray, command = colorShuffle(inputArray, deadline, channelMax)
+    key += command
+    inputArray, command = dummyPixelGenerator(inputArray, deadline, channelMax)
+    key += command
+    dummyPixelCount = len(inputArray)
+    inputArray= arrayToGrid(inputArray, deadline, channelMax)
 
     num_manipulationround = random.randint(2, 6)
+    grid, manipulationCommands = manipulationRounds(inputArray, num_manipulationround, deadline)
+    return grid, key, manipulationCommands, dummyPixelCount
+
+def manipulationRounds(grid, num_manipulationround, deadline=None):
+    """Apply random M/m rounds to the grid, returns it with their commands in order"""
+    manipulationCommands = []
     for i in range(num_manipulationround):
+        if deadline is not None:
+            deadline.check("manipulation rounds")
         if random.randint(0,1) == 1:
-            inputArray= matrixObfuscation(inputArray)
+            grid, command = matrixObfuscation(grid, deadline)
         else:
-            inputArray = detMultiplier(inputArray)
+            grid, command = detMultiplier(grid, deadline)
+        if command is not None:
+            manipulationCommands.append(command)
 
-    return inputArray
+    return grid, manipulationCommands
 
-def matrixObfuscation(grid):
+def matrixObfuscation(grid, deadline=None):
     """Apply reversible 3x3 matrix transformation using modular arithmetic (mod 256)
-    Expects grid format: list of rows, each row contains pixels"""
-    global manipulationCommands
-    
-    # Generate a random 3x3 matrix with odd determinant (coprime with 256)
-    max_attempts = 100
-    for attempt in range(max_attempts):
-        # Use small random integers to avoid overflow
-        M = np.random.randint(-5, 6, (3, 3))
-        det = int(np.round(np.linalg.det(M)))
-        
-        # Check if determinant is odd (coprime with 256)
-        if det % 2 != 0:
-            # Verify the inverse exists
-            M_inv = matrix_inverse_mod(M, 256)
-            if M_inv is not None:
-                break
-    else:
-        # Fallback to identity matrix if no valid matrix found
-        M = np.eye(3, dtype=int)
+    Expects grid format: list of rows, each row contains pixels
+    Returns the transformed grid and its 'M' command"""
+    M = randomInvertibleMatrix()
     
     # Process grid format: list of rows, each row contains pixels
     transformedGrid = []
     for row in grid:
+        if deadline is not None:
+            deadline.check("matrix obfuscation")
         transformedRow = []
         for pixel in row:
             pixel_vec = np.array(pixel, dtype=int)
@@ -138,36 +197,30 @@ def matrixObfuscation(grid):
     matrix_flat = M.flatten().tolist()
     matrix_str = ','.join(map(str, matrix_flat))
     
-    # Calculate total command length: <length_digits><type><data>
-    # We need to account for the length prefix itself
-    data_plus_type = 1 + len(matrix_str)  # 'M' + data
-    length_digits = len(str(data_plus_type))
-    total_length = length_digits + data_plus_type
-    
-    command = f"{total_length}M{matrix_str}"
-    manipulationCommands.append(command)  # Store in array
+    command = buildCommand('M', matrix_str)
     
-    return transformedGrid
+    return transformedGrid, command
 
-def dummyPixelGenerator(inputArray):
-    global key
+def dummyPixelGenerator(inputArray, deadline=None, channelMax=NULL_CHAR_INDEX):
+    """Returns the pixels with dummies inserted and the 'd' command"""
     dummyMultiplier = random.randint(2, 7)
     finalArray = []
     
     # inputArray is now 2D: [[R, G, B], [R, G, B], ...]
     for i in range(len(inputArray)):
+        if deadline is not None and i % BAND_PIXELS == 0:
+            deadline.check("dummy pixel generation")
         # Add dummy pixels before each real pixel
         for j in range(dummyMultiplier):
-            dummyPixel = [random.randint(0, NULL_CHAR_INDEX) for _ in range(3)]
+            dummyPixel = [random.randint(0, channelMax) for _ in range(3)]
             finalArray.append(dummyPixel)
         # Add the real pixel
         finalArray.append(inputArray[i])
 
-    key += "3d"+str(dummyMultiplier)
-    return finalArray
+    return finalArray, "3d"+str(dummyMultiplier)
 
-def colorShuffle(inputArray):
-    global key
+def colorShuffle(inputArray, deadline=None, channelMax=NULL_CHAR_INDEX):
+    """Returns the pixels and the 's' command"""
     # Shuffle channel order
     channels = [0, 1, 2]
     random.shuffle(channels)
@@ -193,7 +246,9 @@ def colorShuffle(inputArray):
     charIndex = 0
     
     for i in range(numPixels):
-        pixel = [NULL_CHAR_INDEX, NULL_CHAR_INDEX, NULL_CHAR_INDEX]  # Default to null character
+        if deadline is not None and i % BAND_PIXELS == 0:
+            deadline.check("color shuffle")
+        pixel = [channelMax, channelMax, channelMax]  # Default to null character
         
         # Place character data in used channels
         for channelPos in usedChannels:
@@ -201,11 +256,11 @@ def colorShuffle(inputArray):
                 pixel[channelPos] = inputArray[charIndex]
                 charIndex += 1
             else:
-                pixel[channelPos] = NULL_CHAR_INDEX  # Null character for padding
+                pixel[channelPos] = channelMax  # Null character for padding
         
         # Fill removed channels with random values
         for channelPos in removedChannels:
-            pixel[channelPos] = random.randint(0, NULL_CHAR_INDEX)
+            pixel[channelPos] = random.randint(0, channelMax)
         
         pixelData.append(pixel)
     
@@ -214,8 +269,7 @@ def colorShuffle(inputArray):
     for ch in usedChannels:
         command += str(ch)
     
-    key += command
-    return pixelData
+    return pixelData, command
 
 
 def dimensionChecker(inputArray):
@@ -229,13 +283,12 @@ def dimensionChecker(inputArray):
     return width, height
 
 
-def detMultiplier(grid):
+def detMultiplier(grid, deadline=None):
     """Apply determinant-based cascading transformation
-    Uses determinant of 3 consecutive pixels to modify each pixel in sequence"""
-    global manipulationCommands
-    
+    Uses determinant of 3 consecutive pixels to modify each pixel in sequence
+    Returns the transformed grid and its 'm' command (None for an empty grid)"""
     if len(grid) == 0 or len(grid[0]) == 0:
-        return grid
+        return grid, None
     
     # Flatten the grid to make processing easier
     flatPixels = []
@@ -258,18 +311,14 @@ def detMultiplier(grid):
     pixelRight = flatPixels[rightIndex][:]
     
     # Store the picked position in the key
-    # Calculate total command length: <length_digits><type><data>
-    data_str = str(pickedIndex)
-    data_plus_type = 1 + len(data_str)  # 'm' + data
-    length_digits = len(str(data_plus_type))
-    total_length = length_digits + data_plus_type
-    
-    command = f"{total_length}m{data_str}"
-    manipulationCommands.append(command)  # Store in array
+    command = buildCommand('m', str(pickedIndex))
     
     # Start transformation from the second row (index = width)
     # First row is random and should not be modified
     for i in range(width, len(flatPixels)):
+        if deadline is not None and i % BAND_PIXELS == 0:
+            deadline.check("determinant cascade")
+        
         # Calculate determinant of 3x3 matrix
         matrix = np.array([pixelLeft, pickedPixel, pixelRight], dtype=int)
         det = int(np.round(np.linalg.det(matrix)))
@@ -300,17 +349,17 @@ def detMultiplier(grid):
                 pixelIndex += 1
         newGrid.append(row)
     
-    return newGrid
+    return newGrid, command
 
 
-def arrayToGrid(inputArray):
+def arrayToGrid(inputArray, deadline=None, channelMax=NULL_CHAR_INDEX):
 
     width, height = dimensionChecker(inputArray)
     
     # Create a random row at the top
     randomRow = []
     for i in range(width):
-        randomPixel = [random.randint(0, NULL_CHAR_INDEX) for _ in range(3)]
+        randomPixel = [random.randint(0, channelMax) for _ in range(3)]
         randomRow.append(randomPixel)
     
     # Create the grid with random row at top
@@ -319,6 +368,8 @@ def arrayToGrid(inputArray):
     # Add the actual data rows
     pixelIndex = 0
     for y in range(height):
+        if deadline is not None:
+            deadline.check("grid layout")
         row = []
         for x in range(width):
             if pixelIndex < len(inputArray):
@@ -326,27 +377,72 @@ def arrayToGrid(inputArray):
                 pixelIndex += 1
             else:
                 # Padding with null pixels if needed
-                row.append([NULL_CHAR_INDEX, NULL_CHAR_INDEX, NULL_CHAR_INDEX])
+                row.append([channelMax, channelMax, channelMax])
         grid.append(row)
     
     return grid
 
     
-def encryption(userText):
-    global key, manipulationCommands
-    key = ""  # Reset key for new encryption
-    manipulationCommands = []  # Reset manipulation commands
+def encryption(userText, deadline=None, output_path=None, packed=False):
+    """Encrypt text into output_image.png (or output_path, a path or file object)
+    and return the key. An optional governor.Deadline is checked between stages and pixel bands.
+    packed=True bit-packs 4 symbols into 3 bytes for a ~25% smaller image"""
     print(userText)
     textSize = len(userText)
-    img = textToArray(textSize, userText)
+    img, key, manipulationCommands, dummyPixelCount = textToArray(textSize, userText, deadline, packed)
+    
+    # Record image shape and checksum so a mismatched key is rejected early
+    key += imageInfoCommand(img.width, img.height, dummyPixelCount, img.tobytes())
     
     # Now append manipulation commands in REVERSE order to the key
     # So decryption can just read them in order
     for command in reversed(manipulationCommands):
         key += command
     
-    # Save to project root to match download endpoints
-    output_path = os.path.join(os.getcwd(), "output_image.png")
-    img.save(output_path)
+    # Save to project root to match download endpoints, unless told otherwise
+    if output_path is None:
+        output_path = os.path.join(os.getcwd(), "output_image.png")
+    img.save(output_path, format='PNG')
+    print(f"Encryption Key: {key}")
+    return key
+
+
+def reencryption(image_path, encryptionKey, rounds=None, deadline=None, output_path=None):
+    """Add manipulation rounds on top of an existing encrypted image
+    The new commands go in front of the old ones, so decryption() undoes them
+    first. Returns the new key; the image is written like encryption() does"""
+    if rounds is None:
+        rounds = random.randint(2, 6)
+    if rounds < 1:
+        raise ValueError("Re-encryption needs at least one round")
+    
+    img = Image.open(image_path)
+    commands = parseKey(encryptionKey)
+    if not any(cmd['type'] == 'd' for cmd in commands) or not any(cmd['type'] == 's' for cmd in commands):
+        raise ValueError("Invalid key: missing 'd' or 's' command.")
+    error = checkImageSize(commands, img.size) or checkImageChecksum(commands, img.tobytes())
+    if error:
+        raise ValueError(error)
+    
+    grid, manipulationCommands = manipulationRounds(imgToGrid(img, deadline), rounds, deadline)
+    img = gridToImage(grid, deadline)
+    
+    # Same layout as encryption(): other commands, i, then manipulation commands newest first
+    key = ""
+    for command in commands:
+        if command['type'] not in ['M', 'm', 'i']:
+            key += buildCommand(command['type'], command['data'])
+    info = parseImageInfo(commands)
+    if info is not None:
+        key += imageInfoCommand(img.width, img.height, info[2], img.tobytes())
+    for command in reversed(manipulationCommands):
+        key += command
+    for command in commands:
+        if command['type'] in ['M', 'm']:
+            key += buildCommand(command['type'], command['data'])
+    
+    if output_path is None:
+        output_path = os.path.join(os.getcwd(), "output_image.png")
+    img.save(output_path, format='PNG')
     print(f"Encryption Key: {key}")
     return key
@@ -0,0 +1,107 @@
+from collections import Counter
+import threading
+import math
+import time
+import os
+
+# Budgets can be tuned per deployment through environment variables
+MAX_IMAGE_PIXELS = int(os.environ.get('IMAGECRYPTO_MAX_IMAGE_PIXELS', 4_000_000))
+# Worst case is 8 pixels per character (one channel, 7 dummies) plus the top row,
+# so by default any text within budget encrypts to an image /decrypt accepts
+MAX_TEXT_BYTES = int(os.environ.get('IMAGECRYPTO_MAX_TEXT_BYTES', MAX_IMAGE_PIXELS // 9))
+MAX_KEY_COMMANDS = int(os.environ.get('IMAGECRYPTO_MAX_KEY_COMMANDS', 16))
+DEADLINE_SECONDS = float(os.environ.get('IMAGECRYPTO_DEADLINE_SECONDS', 30))
+# Engine behind /encrypt and /decrypt: 'single' or 'sharded' (see sharded.py)
+ENGINE = os.environ.get('IMAGECRYPTO_ENGINE', 'single')
+
+# How many pixels to process between two deadline checks
+BAND_PIXELS = 4096
+
+# Metric: number of rejected requests per budget
+violations = Counter()
+violationsLock = threading.Lock()
+
+
+class BudgetExceeded(Exception):
+    """Raised when a request goes over one of the resource budgets"""
+
+    def __init__(self, budget, message):
+        super().__init__(message)
+        self.budget = budget
+
+
+def recordViolation(budget):
+    """Count a budget violation for the metrics endpoint"""
+    with violationsLock:
+        violations[budget] += 1
+
+
+def violationCounts():
+    """Return a snapshot of the violation counters"""
+    with violationsLock:
+        return dict(violations)
+
+
+def fail(budget, message):
+    """Record the violation and raise BudgetExceeded"""
+    recordViolation(budget)
+    raise BudgetExceeded(budget, message)
+
+
+def checkTextBytes(numBytes, limit=None):
+    limit = MAX_TEXT_BYTES if limit is None else limit
+    if numBytes > limit:
+        fail('text_bytes', f"Text is too large: {numBytes} bytes (limit {limit}).")
+
+
+def checkImagePixels(size, limit=None):
+    """Check an image size, as read from the PNG header, against the pixel budget"""
+    limit = MAX_IMAGE_PIXELS if limit is None else limit
+    width, height = size
+    if width * height > limit:
+        fail('image_pixels', f"Image is too large: {width}x{height} pixels (limit {limit}).")
+
+
+def projectedPixels(textLength, packed=False):
+    """Largest image (in pixels) encryption() can produce for a text of this length:
+    one used channel, 7 dummy pixels per real pixel, plus the top row and padding"""
+    symbols = -(-textLength // 4) * 3 if packed else textLength
+    expanded = symbols * 8
+    if expanded == 0:
+        return 2
+    width = int(math.sqrt(expanded))
+    height = -(-expanded // width)
+    return width * (height + 1)
+
+
+def checkProjectedPixels(textLength, packed=False, limit=None):
+    """Reject a text whose encrypted image could exceed the pixel budget"""
+    limit = MAX_IMAGE_PIXELS if limit is None else limit
+    pixels = projectedPixels(textLength, packed)
+    if pixels > limit:
+        fail('image_pixels', f"Text is too long: its image could reach {pixels} pixels (limit {limit}).")
+
+
+def checkKeyCommands(commands, extra=0, limit=None):
+    """Check the number of manipulation (M and m) commands in a parsed key,
+    plus `extra` rounds that are about to be added to it"""
+    limit = MAX_KEY_COMMANDS if limit is None else limit
+    count = len([cmd for cmd in commands if cmd['type'] in ['M', 'm']]) + extra
+    if count > limit:
+        fail('key_commands', f"Key has too many manipulation commands: {count} (limit {limit}).")
+
+
+class Deadline:
+    """Wall-clock budget for one request, checked between stages and pixel bands"""
+
+    def __init__(self, seconds=None):
+        self.seconds = DEADLINE_SECONDS if seconds is None else seconds
+        # time.time() rather than monotonic so worker processes can share it
+        self.expiresAt = time.time() + self.seconds
+
+    def expired(self):
+        return time.time() > self.expiresAt
+
+    def check(self, stage):
+        if self.expired():
+            fail('deadline', f"Request took longer than {self.seconds:g} seconds (stopped during {stage}).")
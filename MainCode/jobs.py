@@ -0,0 +1,140 @@
+from collections import deque
+import contextlib
+import multiprocessing
+import argparse
+import base64
+import json
+import sys
+import io
+
+import numpy as np
+
+import encryption
+import sharded
+
+
+def encryptJob(job, engine='single'):
+    """Encrypt job['text']; write the PNG to job['image_path'] or return it as base64"""
+    encrypt, _ = sharded.engineFunctions(engine)
+    outputPath = job.get('image_path')
+    packed = bool(job.get('packed', False))
+    if outputPath:
+        key = encrypt(job['text'], output_path=outputPath, packed=packed)
+        return {'key': key, 'image_path': outputPath}
+
+    buffer = io.BytesIO()
+    key = encrypt(job['text'], output_path=buffer, packed=packed)
+    return {'key': key, 'image_base64': base64.b64encode(buffer.getvalue()).decode('ascii')}
+
+
+def jobImage(job):
+    """Return the input image of a job as a path or an in-memory file"""
+    if job.get('image_path'):
+        return job['image_path']
+    if job.get('image_base64'):
+        return io.BytesIO(base64.b64decode(job['image_base64']))
+    raise ValueError(f"{job.get('op')} job needs 'image_path' or 'image_base64'")
+
+
+def decryptJob(job, engine='single'):
+    """Decrypt the image at job['image_path'] or in job['image_base64'] with job['key']"""
+    _, decrypt = sharded.engineFunctions(engine)
+    return {'text': decrypt(job['key'], jobImage(job))}
+
+
+def reencryptJob(job):
+    """Add job['rounds'] rounds to an encrypted image; write it to job['output_path'] or return it as base64"""
+    image = jobImage(job)
+    outputPath = job.get('output_path')
+    if outputPath:
+        key = encryption.reencryption(image, job['key'], job.get('rounds'), output_path=outputPath)
+        return {'key': key, 'image_path': outputPath}
+
+    buffer = io.BytesIO()
+    key = encryption.reencryption(image, job['key'], job.get('rounds'), output_path=buffer)
+    return {'key': key, 'image_base64': base64.b64encode(buffer.getvalue()).decode('ascii')}
+
+
+def runJob(line, engine='single'):
+    """Run one JSON request line and return the JSON response line"""
+    job = None
+    try:
+        job = json.loads(line)
+        if not isinstance(job, dict):
+            raise ValueError("Request must be a JSON object")
+        op = job.get('op')
+        # stdout carries the responses, keep the engine's prints off it
+        with contextlib.redirect_stdout(sys.stderr):
+            if op == 'encrypt':
+                result = encryptJob(job, engine)
+            elif op == 'decrypt':
+                result = decryptJob(job, engine)
+            elif op == 'reencrypt':
+                result = reencryptJob(job)
+            else:
+                raise ValueError(f"Unknown op: {op!r} (expected 'encrypt', 'decrypt' or 'reencrypt')")
+        response = {'id': job.get('id'), 'success': True}
+        response.update(result)
+    except Exception as e:
+        jobId = job.get('id') if isinstance(job, dict) else None
+        response = {'id': jobId, 'success': False, 'error': f"{type(e).__name__}: {e}"}
+    return json.dumps(response)
+
+
+def readsImagePath(line):
+    """True when a request line reads an image from disk, which an earlier request may write"""
+    try:
+        job = json.loads(line)
+    except ValueError:
+        return False
+    return isinstance(job, dict) and job.get('op') in ['decrypt', 'reencrypt'] and bool(job.get('image_path'))
+
+
+def reseedWorker():
+    # Forked workers inherit the parent's NumPy random state, give each its own
+    np.random.seed()
+
+
+def serve(inputStream=None, outputStream=None, workers=1, engine='single'):
+    """Read requests as JSON lines and write one response line per request, in order
+    With workers > 1 requests run concurrently, except that one reading an
+    image_path waits for every earlier request, so it sees files they wrote"""
+    inputStream = sys.stdin if inputStream is None else inputStream
+    outputStream = sys.stdout if outputStream is None else outputStream
+    lines = (line for line in inputStream if line.strip())
+
+    if workers > 1:
+        def writeResponse(pending):
+            outputStream.write(pending.popleft().get() + "\n")
+            outputStream.flush()
+
+        pending = deque()
+        with multiprocessing.Pool(workers, initializer=reseedWorker) as pool:
+            for line in lines:
+                if readsImagePath(line):
+                    while pending:
+                        writeResponse(pending)
+                pending.append(pool.apply_async(runJob, (line,)))
+                while pending and pending[0].ready():
+                    writeResponse(pending)
+            while pending:
+                writeResponse(pending)
+    else:
+        for line in lines:
+            outputStream.write(runJob(line, engine) + "\n")
+            outputStream.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="main.py serve",
+        description="Read encrypt/decrypt/reencrypt requests as JSON lines on stdin and write results on stdout.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes (default: 1, run in this process)")
+    parser.add_argument('--engine', choices=sharded.ENGINES, default='single',
+                        help="engine for encrypt/decrypt jobs; 'sharded' spreads each job over all CPUs (default: single)")
+    args = parser.parse_args(argv)
+    if args.engine == 'sharded' and args.workers > 1:
+        # Pool workers are daemonic and cannot start the sharded engine's processes
+        parser.error("--engine sharded runs one job at a time, use it with --workers 1")
+    serve(workers=args.workers, engine=args.engine)
@@ -0,0 +1,349 @@
+"""Local HTTP load test for the Flask app
+
+Starts app.py in a subprocess (in a scratch directory, so output_image.png in
+the repo is left alone), drives /encrypt, /decrypt, /get-image and
+/download-image from a pool of client threads and writes a JSON report:
+throughput, p50/p95/p99 latency, error rate and server RSS.
+
+    python MainCode/loadtest.py --concurrency 8 --duration 30 --output run.json
+"""
+from urllib.error import HTTPError, URLError
+from http.client import HTTPException
+import urllib.request
+import subprocess
+import threading
+import argparse
+import tempfile
+import random
+import socket
+import string
+import math
+import json
+import time
+import uuid
+import sys
+import os
+
+MAIN_CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ['encrypt', 'decrypt', 'get-image', 'download-image']
+
+SERVER_SCRIPT = """
+import sys
+sys.path.insert(0, {mainCode!r})
+import app
+app.app.run(host='127.0.0.1', port={port}, debug=False, use_reloader=False, threaded={threaded}, processes={processes})
+"""
+
+
+def parseMix(text, names=None):
+    """Parse 'name:weight,name:weight' into a list of (name, weight)"""
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition(':')
+        name = name.strip()
+        if names is not None and name not in names:
+            raise argparse.ArgumentTypeError(f"Unknown name {name!r} (expected one of {', '.join(names)})")
+        mix.append((name, float(weight) if weight else 1.0))
+    return mix
+
+
+def percentile(sortedValues, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sortedValues:
+        return None
+    rank = max(1, math.ceil(fraction * len(sortedValues)))
+    return sortedValues[rank - 1]
+
+
+def latencySummary(latencies):
+    values = sorted(latencies)
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None, 'max': None}
+    return {
+        'p50': round(percentile(values, 0.50), 2),
+        'p95': round(percentile(values, 0.95), 2),
+        'p99': round(percentile(values, 0.99), 2),
+        'mean': round(sum(values) / len(values), 2),
+        'max': round(values[-1], 2),
+    }
+
+
+def encodeMultipart(fields, files=None):
+    """Encode form fields and files as multipart/form-data, returns (body, content type)"""
+    boundary = uuid.uuid4().hex
+    lines = []
+    for name, value in fields.items():
+        lines.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode())
+        lines.append(value.encode('utf-8') + b'\r\n')
+    for name, (filename, data, mimetype) in (files or {}).items():
+        lines.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: {mimetype}\r\n\r\n'.encode())
+        lines.append(data + b'\r\n')
+    lines.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(lines), f'multipart/form-data; boundary={boundary}'
+
+
+def randomText(size):
+    alphabet = string.ascii_lowercase + string.digits + '      .,!?\n'
+    return ''.join(random.choice(alphabet) for _ in range(size))
+
+
+def processRssKb(pid):
+    """Resident set size of one process in KB, None where /proc is unavailable"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def childPids(pid):
+    """Direct children of a process, from /proc/<pid>/task/*/children"""
+    children = []
+    try:
+        tasks = os.listdir(f'/proc/{pid}/task')
+    except OSError:
+        return children
+    for task in tasks:
+        try:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children += [int(child) for child in f.read().split()]
+        except OSError:
+            pass
+    return children
+
+
+def serverRssKb(pid):
+    """Resident set size of the server and all its child processes in KB,
+    None where /proc is unavailable"""
+    total = processRssKb(pid)
+    if total is None:
+        return None
+    pending = childPids(pid)
+    while pending:
+        child = pending.pop()
+        # Forked request handlers can exit between listing and reading
+        total += processRssKb(child) or 0
+        pending += childPids(child)
+    return total
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Client:
+    """Issues requests against the local server and times them"""
+
+    def __init__(self, baseUrl, timeout):
+        self.baseUrl = baseUrl
+        self.timeout = timeout
+
+    def request(self, path, fields=None, files=None):
+        """Send one request; returns (ok, latency in ms, response body)"""
+        if fields is None and files is None:
+            request = urllib.request.Request(self.baseUrl + path)
+        else:
+            body, contentType = encodeMultipart(fields or {}, files)
+            request = urllib.request.Request(self.baseUrl + path, data=body, headers={'Content-Type': contentType})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = response.read()
+                ok = response.status == 200
+        except (HTTPError, URLError, HTTPException, OSError):
+            data = b''
+            ok = False
+        latency = (time.perf_counter() - start) * 1000
+        if ok and path in ('/encrypt', '/decrypt'):
+            # These routes answer 200 with success false on failure
+            try:
+                ok = bool(json.loads(data).get('success'))
+            except ValueError:
+                ok = False
+        return ok, latency, data
+
+
+def startServer(args, workDir):
+    port = args.port or freePort()
+    script = SERVER_SCRIPT.format(mainCode=MAIN_CODE_DIR, port=port,
+                                  threaded=args.processes <= 1, processes=args.processes)
+    env = dict(os.environ)
+    env['IMAGECRYPTO_ENGINE'] = args.backend
+    for item in args.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+    server = subprocess.Popen([sys.executable, '-c', script], cwd=workDir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    baseUrl = f'http://127.0.0.1:{port}'
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited during startup with code {server.returncode}")
+        try:
+            with urllib.request.urlopen(baseUrl + '/', timeout=1):
+                return server, baseUrl
+        except (URLError, OSError):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"Server did not answer within {args.startup_timeout} seconds")
+
+
+def serverEngine(client):
+    """Engine the server reports on /metrics, None if it does not say"""
+    ok, _, data = client.request('/metrics')
+    if not ok:
+        return None
+    try:
+        return json.loads(data).get('engine')
+    except ValueError:
+        return None
+
+
+def prepareFixtures(client, sizes):
+    """Encrypt one text per payload size so /decrypt has matching key/image pairs"""
+    fixtures = {}
+    for size, _ in sizes:
+        ok, _, data = client.request('/encrypt', {'text': randomText(int(size))})
+        if not ok:
+            raise RuntimeError(f"Could not prepare a {int(size)} byte fixture: {data[:200]!r}")
+        key = json.loads(data)['key']
+        ok, _, image = client.request('/get-image')
+        if not ok:
+            raise RuntimeError("Could not fetch the fixture image")
+        fixtures[size] = (key, image)
+    return fixtures
+
+
+def runLoad(client, args, fixtures):
+    """Run client threads until the duration is over, returns per-endpoint results"""
+    endpoints, endpointWeights = zip(*args.mix)
+    sizes, sizeWeights = zip(*args.sizes)
+    results = {name: {'latencies': [], 'errors': 0} for name in endpoints}
+    lock = threading.Lock()
+    stopAt = time.perf_counter() + args.duration
+
+    def worker():
+        texts = {size: randomText(int(size)) for size in sizes}
+        while time.perf_counter() < stopAt:
+            endpoint = random.choices(endpoints, endpointWeights)[0]
+            size = random.choices(sizes, sizeWeights)[0]
+            if endpoint == 'encrypt':
+                ok, latency, _ = client.request('/encrypt', {'text': texts[size]})
+            elif endpoint == 'decrypt':
+                key, image = fixtures[size]
+                ok, latency, _ = client.request('/decrypt', {'key': key}, {'image': ('image.png', image, 'image/png')})
+            else:
+                ok, latency, _ = client.request('/' + endpoint)
+            with lock:
+                results[endpoint]['latencies'].append(latency)
+                if not ok:
+                    results[endpoint]['errors'] += 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def buildReport(args, results, elapsed, rss, engine):
+    allLatencies = []
+    totalErrors = 0
+    endpoints = {}
+    for name, result in results.items():
+        count = len(result['latencies'])
+        allLatencies += result['latencies']
+        totalErrors += result['errors']
+        endpoints[name] = {
+            'requests': count,
+            'errors': result['errors'],
+            'error_rate': round(result['errors'] / count, 4) if count else 0.0,
+            'throughput_rps': round(count / elapsed, 2),
+            'latency_ms': latencySummary(result['latencies']),
+        }
+    total = len(allLatencies)
+    rssSamples = [value for value in rss if value is not None]
+    return {
+        'label': args.label,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {
+            'concurrency': args.concurrency,
+            'duration_s': args.duration,
+            'mix': dict(args.mix),
+            'sizes': {str(int(size)): weight for size, weight in args.sizes},
+            'processes': args.processes,
+            'backend': engine,
+            'env': args.env,
+        },
+        'elapsed_s': round(elapsed, 2),
+        'requests': total,
+        'errors': totalErrors,
+        'error_rate': round(totalErrors / total, 4) if total else 0.0,
+        'throughput_rps': round(total / elapsed, 2),
+        'latency_ms': latencySummary(allLatencies),
+        'endpoints': endpoints,
+        'server_rss_kb': {
+            'start': rssSamples[0] if rssSamples else None,
+            'peak': max(rssSamples) if rssSamples else None,
+            'end': rssSamples[-1] if rssSamples else None,
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the ImageCryptography web app on localhost.")
+    parser.add_argument('--concurrency', type=int, default=4, help="client threads (default: 4)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load (default: 10)")
+    parser.add_argument('--mix', type=lambda text: parseMix(text, ENDPOINTS),
+                        default=parseMix('encrypt:4,decrypt:4,get-image:1,download-image:1'),
+                        help="endpoint weights (default: encrypt:4,decrypt:4,get-image:1,download-image:1)")
+    parser.add_argument('--sizes', type=parseMix, default=parseMix('100:6,1000:3,5000:1'),
+                        help="text sizes in bytes with weights (default: 100:6,1000:3,5000:1)")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="server worker processes; 1 runs a threaded server (default: 1)")
+    parser.add_argument('--backend', choices=['single', 'sharded'], default='single',
+                        help="engine the server runs /encrypt and /decrypt on, via IMAGECRYPTO_ENGINE (default: single)")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="extra environment for the server, e.g. IMAGECRYPTO_DEADLINE_SECONDS=5")
+    parser.add_argument('--port', type=int, default=0, help="server port (default: a free port)")
+    parser.add_argument('--timeout', type=float, default=60, help="per-request timeout in seconds (default: 60)")
+    parser.add_argument('--startup-timeout', type=float, default=30, help="seconds to wait for the server")
+    parser.add_argument('--label', default='', help="free-form name stored in the report")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    args.sizes = [(float(size), weight) for size, weight in args.sizes]
+
+    with tempfile.TemporaryDirectory() as workDir:
+        server, baseUrl = startServer(args, workDir)
+        try:
+            client = Client(baseUrl, args.timeout)
+            engine = serverEngine(client)
+            fixtures = prepareFixtures(client, args.sizes)
+
+            rss = [serverRssKb(server.pid)]
+            start = time.perf_counter()
+            threads, results = runLoad(client, args, fixtures)
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(0.5)
+                rss.append(serverRssKb(server.pid))
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+
+    report = json.dumps(buildReport(args, results, elapsed, rss, engine), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
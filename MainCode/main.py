@@ -1,31 +1,51 @@
 import encryption
 import decryption
+import jobs
+import sys
 import os
-mode = None
-status = True
-while(status):
-    print("Input mode desired to be used \n 1. For Text to Image Generation \n 2. For Image decryption") 
-    mode =input()
-    if(mode == "1"):
-        print("\nText to Image Generation Mode Chosen\n")
+
+
+def interactive():
+    mode = None
+    status = True
+    while(status):
+        print("Input mode desired to be used \n 1. For Text to Image Generation \n 2. For Image decryption \n 3. For adding rounds to an encrypted image") 
+        mode =input()
+        if(mode == "1"):
+            print("\nText to Image Generation Mode Chosen\n")
         
-        textOrImage=input("Would you like to input text via (1) Direct Input or (2) Input File? ")
+            textOrImage=input("Would you like to input text via (1) Direct Input or (2) Input File? ")
         
-        if textOrImage =="1":
-            text = input("Enter the text to convert to image: ")
-            encryption.encryption(text)
-        elif textOrImage =="2":
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            file_path = os.path.join(script_dir, "testText")
-            with open(file_path, 'r', encoding='utf-8') as f:
-                text = f.read()
-            encryption.encryption(text)
-        status = False
-    elif (mode =="2"):
-        print("\nImage Decoder Mode Chosen\n")
-        key = input("Enter the decryption key: ")
-        decryption.decryption(key)
-        status = False
+            if textOrImage =="1":
+                text = input("Enter the text to convert to image: ")
+                encryption.encryption(text)
+            elif textOrImage =="2":
+                script_dir = os.path.dirname(os.path.abspath(__file__))
+                file_path = os.path.join(script_dir, "testText")
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                encryption.encryption(text)
+            status = False
+        elif (mode =="2"):
+            print("\nImage Decoder Mode Chosen\n")
+            key = input("Enter the decryption key: ")
+            decryption.decryption(key)
+            status = False
+        elif (mode =="3"):
+            print("\nRe-encryption Mode Chosen\n")
+            key = input("Enter the current key: ")
+            image_path = input("Enter the image path (blank for output_image.png): ") or os.path.join(os.getcwd(), "output_image.png")
+            rounds = input("How many rounds to add? (blank for random 2-6) ")
+            encryption.reencryption(image_path, key, int(rounds) if rounds else None)
+            status = False
+        else:
+            print("Invalid input, please try again\n")
+            continue
+
+
+if __name__ == "__main__":
+    # `python main.py serve` runs the non-interactive JSON-lines worker
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        jobs.main(sys.argv[2:])
     else:
-        print("Invalid input, please try again\n")
-        continue
+        interactive()
@@ -0,0 +1,366 @@
+from multiprocessing import shared_memory
+from PIL import Image
+import multiprocessing
+import numpy as np
+import threading
+import random
+import os
+
+from governor import BAND_PIXELS
+import encryption
+import decryption
+from encryption import numToLetter, NULL_CHAR_INDEX, PACKED_CHANNEL_MAX, buildCommand, randomInvertibleMatrix, dimensionChecker, imageInfoCommand, packSymbols
+from decryption import parseKey, matrix_inverse_mod, checkImageSize, checkImageChecksum, isPacked, unpackSymbols
+
+# Lookup table used to turn text into alphabet indices
+letterIndex = {letter: index for index, letter in enumerate(numToLetter)}
+# One sharded run at a time across threads, see runStages
+runLock = threading.Lock()
+
+
+def bandRange(total, workerIndex, workers):
+    """Return the [start, stop) slice of `total` items owned by one worker"""
+    start = (total * workerIndex) // workers
+    stop = (total * (workerIndex + 1)) // workers
+    return start, stop
+
+
+def createShared(arrays, name, shape, dtype=np.uint8):
+    """Allocate a shared memory block and register it under `name`"""
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    # Zero-sized blocks are not allowed, keep at least one byte around
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    arrays[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return arrays[name][1]
+
+
+def attachShared(specs):
+    """Attach to the shared blocks described by `specs` inside a worker"""
+    handles = []
+    views = {}
+    for name, (shmName, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shmName)
+        handles.append(shm)
+        views[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return handles, views
+
+
+def detModification(refs):
+    """Compute (det % 4) * 64 for every window of 3 consecutive reference pixels
+    Adding multiples of 64 never changes a value mod 4, so the determinant mod 4
+    is the same whether it is taken from the original or the transformed pixels"""
+    refs = refs.astype(np.int64) % 4
+    a = refs[:-2]
+    b = refs[1:-1]
+    c = refs[2:]
+    det = (a[:, 0] * (b[:, 1] * c[:, 2] - b[:, 2] * c[:, 1])
+           - a[:, 1] * (b[:, 0] * c[:, 2] - b[:, 2] * c[:, 0])
+           + a[:, 2] * (b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0]))
+    return (det % 4) * 64
+
+
+def stageSize(stage, views):
+    """Number of items (pixels) a stage works on, before splitting into bands"""
+    stageType = stage[0]
+    if stageType in ['shuffle', 'unlayout', 'extract']:
+        return len(views['realPixels'])
+    if stageType == 'M':
+        return len(views['grid'])
+    # 'layout' and 'm' skip the random top row
+    return len(views['grid']) - stage[2]
+
+
+def stageChunks(stage, views, workerIndex, workers):
+    """Split the band owned by one worker into chunks of at most BAND_PIXELS items"""
+    start, stop = bandRange(stageSize(stage, views), workerIndex, workers)
+    return [(chunk, min(chunk + BAND_PIXELS, stop)) for chunk in range(start, stop, BAND_PIXELS)]
+
+
+def runStage(stage, views, start, stop):
+    """Run one pipeline stage on items [start, stop) of its range"""
+    stageType = stage[0]
+    grid = views['grid']
+
+    if stageType == 'shuffle':
+        # colorShuffle: place characters in used channels, noise in removed ones
+        _, usedChannels, removedChannels = stage
+        realPixels = views['realPixels']
+        if usedChannels:
+            realPixels[start:stop][:, usedChannels] = views['symbols'][start:stop]
+        if removedChannels:
+            realPixels[start:stop][:, removedChannels] = views['channelNoise'][start:stop]
+
+    elif stageType == 'layout':
+        # dummyPixelGenerator + arrayToGrid: real pixels sit on a fixed stride
+        _, dummyMultiplier, width, padValue = stage
+        realPixels = views['realPixels']
+        dummyNoise = views['dummyNoise']
+        position = np.arange(start, stop)
+        realIndex, slot = np.divmod(position, dummyMultiplier + 1)
+        inData = realIndex < len(realPixels)
+        isReal = inData & (slot == dummyMultiplier)
+        isDummy = inData & (slot != dummyMultiplier)
+
+        band = np.full((stop - start, 3), padValue, dtype=np.uint8)
+        band[isReal] = realPixels[realIndex[isReal]]
+        band[isDummy] = dummyNoise[realIndex[isDummy], slot[isDummy]]
+        grid[width + start:width + stop] = band
+
+    elif stageType == 'M':
+        # matrixObfuscation (or its inverse): independent for every pixel
+        _, matrix = stage
+        band = grid[start:stop].astype(np.int64)
+        grid[start:stop] = (band @ matrix.T) % 256
+
+    elif stageType == 'm':
+        # detMultiplier (sign 1) or its reverse (sign -1), rows below the top row
+        _, pickedIndex, width, sign = stage
+        start += width
+        stop += width
+
+        # Reference pixels: left, picked, right from the top row, then the data
+        # pixels themselves, so each chunk only needs a three pixel halo
+        lead = np.array([grid[(pickedIndex - 1) % width],
+                         grid[pickedIndex],
+                         grid[(pickedIndex + 1) % width]])
+        leadUsed = max(0, width + 3 - start)
+        refs = grid[max(width, start - 3):stop - 1]
+        if leadUsed > 0:
+            refs = np.concatenate([lead[3 - leadUsed:], refs])
+
+        modification = detModification(refs)
+        band = grid[start:stop].astype(np.int64)
+        grid[start:stop] = (band + sign * modification[:, None]) % 256
+
+    elif stageType == 'unlayout':
+        # reverseGrid + reverseDummyPixels: gather every real pixel by stride
+        _, dummyMultiplier, width = stage
+        realPixels = views['realPixels']
+        position = width + np.arange(start, stop) * (dummyMultiplier + 1) + dummyMultiplier
+        realPixels[start:stop] = grid[position]
+
+    elif stageType == 'extract':
+        # reverseColorShuffle: read character data from the used channels
+        _, usedChannels = stage
+        realPixels = views['realPixels']
+        views['symbols'][start:stop] = realPixels[start:stop][:, usedChannels]
+
+
+def stageWorker(workerIndex, workers, specs, stages, barrier, deadline):
+    """Worker process: run every stage on its band, synchronizing on the barrier"""
+    handles, views = attachShared(specs)
+    try:
+        for stage in stages:
+            for start, stop in stageChunks(stage, views, workerIndex, workers):
+                # Stop quietly, the parent reports the expired deadline
+                if deadline is not None and deadline.expired():
+                    barrier.abort()
+                    raise SystemExit(1)
+                runStage(stage, views, start, stop)
+            barrier.wait()
+    except threading.BrokenBarrierError:
+        # Another worker failed and already reported why
+        raise SystemExit(1)
+    except BaseException:
+        # Release the other workers instead of leaving them stuck on the barrier
+        barrier.abort()
+        raise
+    finally:
+        views.clear()
+        for shm in handles:
+            shm.close()
+
+
+def runStages(arrays, stages, workers, deadline=None):
+    """Start the worker processes and wait for them to finish every stage"""
+    # A forked worker can inherit a lock some other thread of the parent was
+    # holding (the web app is threaded) and hang, so start from a clean process
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    context = multiprocessing.get_context(method)
+    barrier = context.Barrier(workers)
+    specs = {name: (shm.name, view.shape, view.dtype.str) for name, (shm, view) in arrays.items()}
+
+    # Each run already uses every worker, and the forkserver loses track of
+    # exit codes when several threads start processes at once
+    with runLock:
+        processes = []
+        for workerIndex in range(workers):
+            process = context.Process(target=stageWorker, args=(workerIndex, workers, specs, stages, barrier, deadline))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
+
+    if any(process.exitcode != 0 for process in processes):
+        if deadline is not None:
+            deadline.check("sharded stages")
+        raise RuntimeError("Sharded worker failed, see the worker traceback above")
+
+
+def releaseShared(arrays):
+    """Close and unlink every shared block created by the parent"""
+    for name in list(arrays):
+        shm, _ = arrays.pop(name)
+        shm.close()
+        shm.unlink()
+
+
+def shardedEncryption(userText, workers=None, deadline=None, output_path=None, packed=False):
+    """Multi-process version of encryption.encryption()
+    All random values are drawn here in the same order as the single-process
+    path, so the key and image are byte-identical to encryption()"""
+    workers = workers or os.cpu_count() or 1
+    print(userText)
+
+    symbolList = [letterIndex.get(char.lower(), NULL_CHAR_INDEX) for char in userText]
+    key = ""
+    channelMax = NULL_CHAR_INDEX
+    if packed:
+        symbolList = packSymbols(symbolList)
+        channelMax = PACKED_CHANNEL_MAX
+        key += buildCommand('p', '6')
+
+    # colorShuffle randomness
+    channels = [0, 1, 2]
+    random.shuffle(channels)
+    usedChannels = channels.copy()
+    for i in range(len(usedChannels)-1):
+        if random.randint(1,3) == 1:
+            usedChannels.pop(0)
+    removedChannels = [ch for ch in [0, 1, 2] if ch not in usedChannels]
+    numPixels = -(-len(symbolList) // len(usedChannels))
+    channelNoise = [random.randint(0, channelMax) for _ in range(numPixels * len(removedChannels))]
+    key += str(2+len(usedChannels)) + "s" + ''.join(str(ch) for ch in usedChannels)
+
+    # dummyPixelGenerator randomness
+    dummyMultiplier = random.randint(2, 7)
+    dummyNoise = [random.randint(0, channelMax) for _ in range(numPixels * dummyMultiplier * 3)]
+    key += "3d"+str(dummyMultiplier)
+
+    # arrayToGrid randomness
+    width, height = dimensionChecker(range(numPixels * (dummyMultiplier + 1)))
+    randomRow = [random.randint(0, channelMax) for _ in range(width * 3)]
+
+    # Manipulation rounds
+    stages = [('shuffle', usedChannels, removedChannels), ('layout', dummyMultiplier, width, channelMax)]
+    manipulationCommands = []
+    num_manipulationround = random.randint(2, 6)
+    for i in range(num_manipulationround):
+        if random.randint(0,1) == 1:
+            M = randomInvertibleMatrix()
+            stages.append(('M', M.astype(np.int64)))
+            manipulationCommands.append(buildCommand('M', ','.join(map(str, M.flatten().tolist()))))
+        else:
+            pickedIndex = random.randint(0, width - 1)
+            stages.append(('m', pickedIndex, width, 1))
+            manipulationCommands.append(buildCommand('m', str(pickedIndex)))
+
+    arrays = {}
+    try:
+        symbols = createShared(arrays, 'symbols', (numPixels, len(usedChannels)))
+        symbols.reshape(-1)[:] = channelMax
+        symbols.reshape(-1)[:len(symbolList)] = symbolList
+        createShared(arrays, 'channelNoise', (numPixels, len(removedChannels)))[:] = \
+            np.array(channelNoise, dtype=np.uint8).reshape(numPixels, len(removedChannels))
+        createShared(arrays, 'dummyNoise', (numPixels, dummyMultiplier, 3))[:] = \
+            np.array(dummyNoise, dtype=np.uint8).reshape(numPixels, dummyMultiplier, 3)
+        createShared(arrays, 'realPixels', (numPixels, 3))
+        grid = createShared(arrays, 'grid', ((height + 1) * width, 3))
+        grid[:width] = np.array(randomRow, dtype=np.uint8).reshape(width, 3)
+
+        runStages(arrays, stages, workers, deadline)
+        img = Image.fromarray(grid.reshape(height + 1, width, 3).copy())
+    finally:
+        releaseShared(arrays)
+
+    # Record image shape and checksum so a mismatched key is rejected early
+    key += imageInfoCommand(width, height + 1, numPixels * (dummyMultiplier + 1), img.tobytes())
+    for command in reversed(manipulationCommands):
+        key += command
+
+    # Save to project root to match download endpoints, unless told otherwise
+    if output_path is None:
+        output_path = os.path.join(os.getcwd(), "output_image.png")
+    img.save(output_path, format='PNG')
+    print(f"Encryption Key: {key}")
+    return key
+
+
+def shardedDecryption(encryptionKey, image_path, workers=None, deadline=None):
+    """Multi-process version of decryption.decryption(), same output"""
+    workers = workers or os.cpu_count() or 1
+    img = Image.open(image_path)
+    if img.mode != 'RGB':
+        raise ValueError(f"Expected an RGB image, got mode {img.mode}")
+    width, height = img.size
+
+    commands = parseKey(encryptionKey)
+
+    # Reject a mismatched key before touching the pixels
+    error = checkImageSize(commands, img.size)
+    if error:
+        raise ValueError(error)
+
+    # Manipulation commands are applied in the order they appear in the key
+    stages = []
+    for command in commands:
+        if command['type'] == 'm':
+            randomPos = int(command['data'])
+            if not -width * height <= randomPos < width * height:
+                raise IndexError("list index out of range")
+            stages.append(('m', randomPos, width, -1))
+        elif command['type'] == 'M':
+            matrix_values = list(map(int, command['data'].split(',')))
+            M_inv = matrix_inverse_mod(np.array(matrix_values).reshape((3, 3)), 256)
+            if M_inv is not None:
+                stages.append(('M', M_inv.astype(np.int64)))
+
+    dummyCommand = [cmd for cmd in commands if cmd['type'] == 'd'][0]
+    dummyMultiplier = int(dummyCommand['data'])
+    if dummyMultiplier < 0:
+        raise ValueError("Dummy multiplier must not be negative")
+    shuffleCommand = [cmd for cmd in commands if cmd['type'] == 's'][0]
+    usedChannels = [int(ch) for ch in shuffleCommand['data']]
+    packed = isPacked(commands)
+    if any(ch > 2 for ch in usedChannels):
+        raise IndexError("list index out of range")
+
+    numReal = (width * (height - 1)) // (dummyMultiplier + 1)
+    stages.append(('unlayout', dummyMultiplier, width))
+    stages.append(('extract', usedChannels))
+
+    arrays = {}
+    try:
+        grid = createShared(arrays, 'grid', (width * height, 3))
+        grid[:] = np.asarray(img, dtype=np.uint8).reshape(-1, 3)
+        error = checkImageChecksum(commands, grid.tobytes())
+        if error:
+            raise ValueError(error)
+        createShared(arrays, 'realPixels', (numReal, 3))
+        symbols = createShared(arrays, 'symbols', (numReal, len(usedChannels)))
+
+        runStages(arrays, stages, workers, deadline)
+        charData = symbols.reshape(-1).tolist()
+        if packed:
+            charData = unpackSymbols(charData)
+    finally:
+        releaseShared(arrays)
+
+    # Convert character indices back to text
+    finalText = ''.join([numToLetter[charNum] for charNum in charData if charNum < NULL_CHAR_INDEX])
+
+    print("Decrypted Text: \n")
+    print(finalText)
+    return finalText
+
+
+ENGINES = ['single', 'sharded']
+
+
+def engineFunctions(engine):
+    """Return the (encrypt, decrypt) pair for an engine name, 'single' or 'sharded'"""
+    if engine == 'single':
+        return encryption.encryption, decryption.decryption
+    if engine == 'sharded':
+        return shardedEncryption, shardedDecryption
+    raise ValueError(f"Unknown engine: {engine!r} (expected one of {', '.join(ENGINES)})")